@@ -1,12 +1,16 @@
+import asyncio
 import logging
 import httpx
-import re
 import os
-import json
+import sys
+from collections import OrderedDict
+from typing import Awaitable, Callable
+import orjson
 from dotenv import load_dotenv
 from telegram import ForceReply, Update
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
-from telegram.constants import ParseMode
+from telegram.constants import ChatAction, MessageLimit, ParseMode
+from telegram.error import RetryAfter, TelegramError
 
 # Enable logging
 logging.basicConfig(
@@ -18,9 +22,29 @@ logger = logging.getLogger(__name__)
 load_dotenv() 
 
 API_BASE = os.getenv("API_BASE", "https://gptcloud.arc53.com")
-API_URL =  API_BASE + "/api/answer"
+# parsed once instead of on every request
+API_URL = httpx.URL(API_BASE + "/api/answer")
+STREAM_URL = httpx.URL(API_BASE + "/stream")
 API_KEY = os.getenv("API_KEY")
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+MAX_QUESTION_LENGTH = 4000
+# number of chats whose conversation history is kept in memory, at least the chat being answered
+IN_MEMORY_MAX = max(1, int(os.getenv("IN_MEMORY_MAX", "10000")))
+# finished turns kept per chat and sent along with a question that has no conversation_id
+MAX_HISTORY_PAIRS = 5
+MAX_HISTORY_CHARS = 2000
+# stream answers from the /stream endpoint, editing the reply as text arrives
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "false").lower() == "true"
+# minimum seconds between edits of a streamed reply
+STREAM_EDIT_INTERVAL = 1.0
+# attempts for an /api/answer request that fails before a response arrives
+MAX_ATTEMPTS = 3
+# connect failures never reach the server, so resending can't answer (and bill) a question twice
+_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+# characters reserved by Telegram's MarkdownV2, see https://core.telegram.org/bots/api#markdownv2-style
+_MD_SPECIALS = frozenset('\\_*[]()~`>#+-=|{}.!')
+_MD_TABLE = str.maketrans({c: '\\' + c for c in _MD_SPECIALS})
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -43,68 +67,219 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.message.reply_text("Help!")
 
 
-async def generate_answer(question: str, messages: list, conversation_id: str | None) -> dict:
-    """Generates an answer using the external API."""
-    payload = {
+def build_payload(question: str, messages: list, conversation_id: str | None) -> dict:
+    """Builds the request body shared by the answer and stream endpoints."""
+    if conversation_id:
+        # DocsGPT keeps the history of a known conversation server-side
+        history = []
+    else:
+        # cap the history before it is serialized, recent turns matter most;
+        # messages ends with the pending turn for this question, so keep one extra
+        history = [{key: text[:MAX_HISTORY_CHARS] for key, text in turn.items()}
+                   for turn in messages[-(MAX_HISTORY_PAIRS + 1):]]
+    return {
         "question": question,
         "api_key": API_KEY,
-        "history": messages,
+        "history": history,
         "conversation_id": conversation_id
     }
-    headers = {
-        "Content-Type": "application/json; charset=utf-8"
-    }
-    timeout = 60.0
-    async with httpx.AsyncClient() as client:
-        response = await client.post(API_URL, json=payload, headers=headers, timeout=timeout)
 
-        if response.status_code == 200:
-            data = response.json()
-            conversation_id = data.get("conversation_id")
-            answer = data.get("answer", "Sorry, I couldn't find an answer.")
-            return {"answer": answer, "conversation_id": conversation_id}
-        else:
-            return {"answer": "Sorry, I couldn't find an answer.", "conversation_id": None}
+
+async def generate_answer(client: httpx.AsyncClient, question: str, messages: list, conversation_id: str | None) -> dict:
+    """Generates an answer using the external API."""
+    # built once, retries resend the same request
+    request = client.build_request(
+        "POST", API_URL, content=orjson.dumps(build_payload(question, messages, conversation_id)))
+    attempt = 1
+    while True:
+        try:
+            response = await client.send(request)
+            break
+        except _RETRYABLE_ERRORS:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            await asyncio.sleep(2 ** (attempt - 1))
+            attempt += 1
+
+    if response.status_code == 200:
+        data = orjson.loads(response.content)
+        conversation_id = data.get("conversation_id")
+        answer = data.get("answer", "Sorry, I couldn't find an answer.")
+        return {"answer": answer, "conversation_id": conversation_id}
+    else:
+        return {"answer": "Sorry, I couldn't find an answer.", "conversation_id": None}
+
+
+async def stream_answer(client: httpx.AsyncClient, question: str, messages: list, conversation_id: str | None,
+                        on_text: Callable[[str], Awaitable[None]]) -> dict:
+    """Streams an answer from the external API, passing the text received so far to on_text."""
+    payload = build_payload(question, messages, conversation_id)
+    # /stream json.loads the history itself, like DocsGPT's web client it takes a JSON string
+    payload["history"] = orjson.dumps(payload["history"]).decode()
+    answer = ""
+    try:
+        async with client.stream("POST", STREAM_URL, content=orjson.dumps(payload)) as response:
+            if response.status_code != 200:
+                return {"answer": "Sorry, I couldn't find an answer.", "conversation_id": None}
+
+            # server-sent events, one JSON object per "data:" line
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = orjson.loads(line[5:])
+                event_type = event.get("type")
+                if event_type == "answer":
+                    answer += event.get("answer", "")
+                    await on_text(answer)
+                elif event_type == "id":
+                    conversation_id = event.get("id")
+                elif event_type == "error":
+                    return {"answer": "Sorry, I couldn't find an answer.", "conversation_id": None}
+                elif event_type == "end":
+                    break
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        # a cut-off stream is not a complete answer, don't let the partial text stand for one
+        logger.warning("Answer stream failed: %s", e)
+        return {"answer": "Sorry, I couldn't find an answer.", "conversation_id": None}
+
+    return {"answer": answer or "Sorry, I couldn't find an answer.", "conversation_id": conversation_id}
 
 
 def escape_markdown(text: str) -> str:
     """Helper function to escape telegram markup symbols."""
-    escape_chars = '\*_\[\]()~>#+-=|{}.!'
-    return re.sub(r'([%s])' % escape_chars, r'\\\1', text)
+    return (text if isinstance(text, str) else str(text)).translate(_MD_TABLE)
+
+
+def format_answer(answer: str) -> tuple[str, str | None]:
+    """Returns the text and parse mode to send an answer with."""
+    # answer is in markdown format, unless it has no markup characters at all
+    if _MD_SPECIALS.isdisjoint(answer):
+        return answer, None
+    return escape_markdown(answer), ParseMode.MARKDOWN_V2
+
+
+async def stream_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, question: str, messages: list,
+                       conversation_id: str | None) -> dict:
+    """Streams the answer into a single message that is edited as text arrives."""
+    message = await update.message.reply_text("…")
+    loop = asyncio.get_running_loop()
+    shown = "…"
+    last_edit = loop.time()
+
+    async def show_partial(text: str) -> None:
+        nonlocal shown, last_edit
+        # Telegram rate-limits edits, so only refresh the message every so often
+        if text == shown or loop.time() - last_edit < STREAM_EDIT_INTERVAL:
+            return
+        # partials are only progress updates, a failed one is skipped and the stream keeps going
+        if len(text) > MessageLimit.MAX_TEXT_LENGTH:
+            return
+        try:
+            await message.edit_text(text)
+        except RetryAfter as e:
+            logger.warning("Streamed reply edits rate-limited for %s s", e.retry_after)
+            # push the next edit back until Telegram accepts them again
+            last_edit = loop.time() + e.retry_after
+            return
+        except TelegramError as e:
+            logger.warning("Could not update streamed reply: %s", e)
+            last_edit = loop.time()
+            return
+        shown = text
+        last_edit = loop.time()
+
+    response_doc = await stream_answer(context.bot_data["http"], question, messages, conversation_id, show_partial)
+
+    # every markup character is escaped, so the final answer renders exactly as its raw text
+    if response_doc["answer"] != shown:
+        text, parse_mode = format_answer(response_doc["answer"])
+        await message.edit_text(text, parse_mode=parse_mode)
+    return response_doc
 
 
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # Store the conversation history in the context
-    if "conversation_history" not in context.chat_data:
-        context.chat_data["conversation_history"] = []
-    if "conversation_id" not in context.chat_data:
-        context.chat_data["conversation_id"] = None
+    question = update.message.text
+    # reject degenerate input before spending a backend request on it
+    if not question or question.isspace():
+        await update.message.reply_text("Please send a non-empty question.")
+        return
+    if len(question) > MAX_QUESTION_LENGTH:
+        await update.message.reply_text(
+            f"Your question is too long, please keep it under {MAX_QUESTION_LENGTH} characters.")
+        return
+
+    # Evict the least recently active chats so chat_data doesn't grow forever
+    recent_chats = context.bot_data["recent_chats"]
+    recent_chats[update.effective_chat.id] = None
+    recent_chats.move_to_end(update.effective_chat.id)
+    while len(recent_chats) > IN_MEMORY_MAX:
+        stale_chat_id, _ = recent_chats.popitem(last=False)
+        context.application.drop_chat_data(stale_chat_id)
+
+    # Store the conversation history in the context, the list is only created on a chat's first message
+    history = context.chat_data.get("conversation_history")
+    if history is None:
+        history = context.chat_data["conversation_history"] = []
+    context.chat_data.setdefault("conversation_id", None)
 
-    context.chat_data["conversation_history"].append({"prompt": update.message.text})
+    history.append({"prompt": question})
     
-    # Generate answer based on current message and conversation history
-    response_doc = await generate_answer(update.message.text, 
-      context.chat_data["conversation_history"], 
-      context.chat_data["conversation_id"])
+    if STREAM_ANSWERS:
+        response_doc = await stream_reply(update, context, question,
+          history,
+          context.chat_data["conversation_id"])
+    else:
+        # Generate answer based on current message and conversation history,
+        # showing "typing..." while the API call is in flight
+        # the indicator is cosmetic, so its failure mustn't cost the user their answer
+        typing_result, response_doc = await asyncio.gather(
+          update.message.chat.send_action(ChatAction.TYPING),
+          generate_answer(context.bot_data["http"], question,
+            history,
+            context.chat_data["conversation_id"]),
+          return_exceptions=True)
+        if isinstance(typing_result, Exception):
+            logger.warning("Could not send typing action: %s", typing_result)
+        if isinstance(response_doc, BaseException):
+            raise response_doc
+
+        text, parse_mode = format_answer(response_doc["answer"])
+        await update.message.reply_text(text, parse_mode=parse_mode)
     
     answer = response_doc["answer"]
     conversation_id = response_doc["conversation_id"]
 
-    # answer is in markdown format
-    answer = escape_markdown(answer)
+    history[-1]["response"] = answer
+    context.chat_data["conversation_id"] = conversation_id
 
-    await update.message.reply_text(answer, parse_mode=ParseMode.MARKDOWN_V2)
+    # trim in place rather than copying the whole list every turn
+    del history[:-MAX_HISTORY_PAIRS]
 
-    context.chat_data["conversation_history"][-1]["response"] = answer
-    context.chat_data["conversation_id"] = conversation_id
 
-    context.chat_data["conversation_history"] = context.chat_data["conversation_history"][-10:]
+async def post_shutdown(application: Application) -> None:
+    """Close the shared HTTP client once the bot has stopped."""
+    await application.bot_data["http"].aclose()
 
 
 def main() -> None:
     """Start the bot."""
+    # libuv-based event loop, not available on Windows
+    if sys.platform != "win32":
+        import uvloop
+        uvloop.install()
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).post_shutdown(post_shutdown).build()
+
+    # one long-lived client so consecutive requests reuse the keep-alive connection
+    application.bot_data["http"] = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(120.0, connect=5.0),
+        # keep idle connections longer than httpx's 5s default to span gaps between messages
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0),
+        headers={"Content-Type": "application/json; charset=utf-8"},
+    )
+    application.bot_data["recent_chats"] = OrderedDict()
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
@@ -114,7 +289,8 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # only plain messages are handled, so don't ask Telegram for other update types
+    application.run_polling(allowed_updates=[Update.MESSAGE], poll_interval=0.0, timeout=30)
 
 
 if __name__ == "__main__":